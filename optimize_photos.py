@@ -0,0 +1,594 @@
+#!/usr/bin/env python3
+"""Optimize event photos for the bi-gnomon galleries.
+
+Resizes photos to a web-friendly width, re-encodes them as JPEG, renames
+them after their EXIF capture time and keeps a backup of each original.
+The output files drop straight into ``images/equinox/`` or
+``images/solstice/`` — see ``images/README.md`` for how the galleries
+pick them up.
+
+Usage:
+    python optimize_photos.py <input_dir> <output_dir> <backup_dir> <event_name>
+
+Example:
+    python optimize_photos.py ~/camera/equinox images/equinox backups/equinox equinox
+
+Each photo's EXIF read, resize, JPEG encode and backup copy are
+independent, so the per-file work runs in a process pool (the JPEG
+encode is CPU-bound and dominates wall time). Filenames are assigned
+up front from a sequential EXIF pre-scan so collisions are resolved
+deterministically regardless of worker completion order.
+"""
+
+import argparse
+import io
+import json
+import os
+import platform
+import queue
+import shutil
+import struct
+import subprocess
+import sys
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from pathlib import Path
+
+from PIL import Image, features
+
+try:
+    import numpy as np
+    from turbojpeg import TJPF_RGB, TJSAMP_420, TurboJPEG
+except ImportError:
+    TurboJPEG = None
+
+# EXIF tag numbers (see the EXIF 2.3 spec, section 4.6).
+EXIF_IFD_POINTER = 0x8769
+DATETIME_ORIGINAL = 0x9003
+
+# Stream buffer size for reading/writing multi-MB photo files; the 8 KB
+# default means needlessly many syscalls at this file size.
+IO_BUFFER_SIZE = 65536
+
+
+def check_jpeg_backend():
+    """Warn if Pillow is not linked against libjpeg-turbo.
+
+    The JPEG encode dominates this script's CPU time, and stock Pillow
+    wheels are sometimes built against plain libjpeg, forgoing turbo's
+    SIMD (SSE2/AVX2/NEON) DCT and Huffman kernels — a 2-6x slowdown for
+    a batch run like this.
+    """
+    if features.check_feature('libjpeg_turbo'):
+        return
+
+    print("WARNING: Pillow is not built against libjpeg-turbo; JPEG "
+          "encoding will be several times slower than it needs to be.")
+    print("  To fix, install the libjpeg-turbo development headers "
+          "(e.g. libjpeg-turbo-devel / libjpeg-turbo8-dev) and rebuild:")
+    print("    pip install --no-binary :all: --force-reinstall pillow")
+    try:
+        cpuinfo = Path('/proc/cpuinfo').read_text()
+        if 'sse4' in cpuinfo or 'avx2' in cpuinfo:
+            print("  On this CPU you can instead install the SIMD fork:")
+            print("    pip uninstall pillow && pip install pillow-simd")
+    except OSError:
+        pass
+    print()
+
+
+def _parse_exif_datetime(s):
+    """Parse the fixed 'YYYY:MM:DD HH:MM:SS' EXIF datetime layout.
+
+    The layout is fixed-width, so explicit slicing skips strptime's
+    format-string interpreter — an order of magnitude faster per call,
+    which adds up in the per-file pre-scan.
+    """
+    return datetime(int(s[0:4]), int(s[5:7]), int(s[8:10]),
+                    int(s[11:13]), int(s[14:16]), int(s[17:19]))
+
+
+def _jpeg_datetime_original(image_path):
+    """Pull DateTimeOriginal straight out of a JPEG's APP1 segment.
+
+    The pre-scan only needs one EXIF tag, and EXIF lives in the first
+    few KB of the file, so read at most 64 KB and walk the TIFF
+    structure by hand instead of constructing a Pillow Image per photo.
+    Returns the raw 'YYYY:MM:DD HH:MM:SS' string, or None when the file
+    isn't a JPEG or the tag can't be found in the window.
+    """
+    with open(image_path, 'rb', buffering=IO_BUFFER_SIZE) as f:
+        head = f.read(IO_BUFFER_SIZE)
+    if head[:2] != b'\xff\xd8':
+        return None
+
+    # Walk the marker segments looking for APP1/Exif; give up at the
+    # scan data (or the end of the 64 KB window).
+    pos = 2
+    tiff = None
+    while pos + 4 <= len(head) and head[pos] == 0xFF:
+        marker = head[pos + 1]
+        if marker == 0xDA:  # start of scan — no EXIF past this point
+            return None
+        length = struct.unpack_from('>H', head, pos + 2)[0]
+        if marker == 0xE1 and head[pos + 4:pos + 10] == b'Exif\x00\x00':
+            tiff = head[pos + 10:pos + 2 + length]
+            break
+        pos += 2 + length
+    if not tiff:
+        return None
+
+    endian = {b'II': '<', b'MM': '>'}.get(tiff[:2])
+    if endian is None:
+        return None
+
+    def _tag_entry(ifd_offset, tag):
+        count = struct.unpack_from(endian + 'H', tiff, ifd_offset)[0]
+        for i in range(count):
+            entry = ifd_offset + 2 + 12 * i
+            if struct.unpack_from(endian + 'H', tiff, entry)[0] == tag:
+                return entry
+        return None
+
+    ifd0 = struct.unpack_from(endian + 'I', tiff, 4)[0]
+    entry = _tag_entry(ifd0, EXIF_IFD_POINTER)
+    if entry is None:
+        return None
+    exif_ifd = struct.unpack_from(endian + 'I', tiff, entry + 8)[0]
+    entry = _tag_entry(exif_ifd, DATETIME_ORIGINAL)
+    if entry is None:
+        return None
+    count = struct.unpack_from(endian + 'I', tiff, entry + 4)[0]
+    offset = struct.unpack_from(endian + 'I', tiff, entry + 8)[0]
+    return tiff[offset:offset + count].rstrip(b'\x00').decode('ascii')
+
+
+def get_exif_datetime_from_image(img):
+    """Read the capture time from an already-open Pillow image.
+
+    Takes the open handle so callers that hold one (the optimize path,
+    the non-JPEG fallback) don't pay for a second open of the file.
+    Returns None when the image carries no DateTimeOriginal.
+    """
+    datetime_str = img.getexif().get_ifd(EXIF_IFD_POINTER).get(
+        DATETIME_ORIGINAL)
+    return _parse_exif_datetime(datetime_str) if datetime_str else None
+
+
+def get_exif_datetime(image_path, fallback_mtime=None):
+    """Return the capture time of a photo, or the file mtime as fallback.
+
+    Callers that already hold a stat result pass fallback_mtime to
+    avoid a second stat syscall.
+    """
+    try:
+        datetime_str = _jpeg_datetime_original(image_path)
+        if datetime_str:
+            return _parse_exif_datetime(datetime_str)
+        # Non-JPEG input (or EXIF outside the 64 KB window): let Pillow
+        # dig the tag out instead.
+        with Image.open(image_path) as img:
+            taken_at = get_exif_datetime_from_image(img)
+        if taken_at:
+            return taken_at
+    except Exception:
+        pass
+    if fallback_mtime is None:
+        fallback_mtime = os.path.getmtime(image_path)
+    return datetime.fromtimestamp(fallback_mtime)
+
+
+# One TurboJPEG handle per process: constructing it loads the library
+# and sets up encode tables, which then amortize across the whole batch.
+_turbojpeg = None
+
+
+def _get_turbojpeg():
+    global _turbojpeg
+    if _turbojpeg is None:
+        _turbojpeg = TurboJPEG()
+    return _turbojpeg
+
+
+def _save_turbojpeg(img, output_path, quality, exif_bytes):
+    """Encode via TurboJPEG's C API instead of Pillow's save.
+
+    tjCompress2 keeps its parameters and tables across calls, and
+    PyTurboJPEG exposes the full SIMD Huffman/IDCT path. TurboJPEG
+    writes no EXIF, so splice the original APP1 segment back in after
+    the SOI marker. Returns the encoded size in bytes.
+    """
+    # pixel_format must say RGB explicitly: TurboJPEG's default is BGR,
+    # which would swap the red and blue channels of the Pillow array.
+    buf = _get_turbojpeg().encode(np.asarray(img), quality=quality,
+                                  pixel_format=TJPF_RGB,
+                                  jpeg_subsample=TJSAMP_420)
+    if exif_bytes and len(exif_bytes) + 2 <= 0xFFFF:
+        app1 = b'\xff\xe1' + struct.pack('>H', len(exif_bytes) + 2) + exif_bytes
+        buf = buf[:2] + app1 + buf[2:]
+    Path(output_path).write_bytes(buf)
+    return len(buf)
+
+
+def _open_for_resize(input_path, max_width):
+    """Open and decode a photo, IDCT-downscaling JPEGs on the way in.
+
+    For a big downscale, libjpeg can decode at 1/2, 1/4 or 1/8 scale:
+    the high-frequency coefficients are never decoded at all, leaving at
+    most a 2x factor for the real resize. draft() is a no-op for
+    non-JPEG input and must run before any pixel access.
+    """
+    img = Image.open(input_path)
+    width = img.size[0]
+    if width > max_width:
+        scale = 1
+        while scale * 2 <= width // max_width and scale < 8:
+            scale *= 2
+        if scale > 1:
+            img.draft('RGB', (img.size[0] // scale, img.size[1] // scale))
+    img.load()
+    return img
+
+
+def optimize_image(input_path, output_path, max_width=1920, quality=82,
+                   progressive=False, optimize=False, turbojpeg=False,
+                   img=None):
+    """Resize a photo to at most max_width and re-encode it as JPEG.
+
+    Pass an already-decoded ``img`` (from _open_for_resize) to skip the
+    decode, e.g. when a read-ahead thread did it in the background.
+    Returns the encoded size in bytes.
+    """
+    if img is None:
+        img = _open_for_resize(input_path, max_width)
+
+    # Pillow keeps the raw EXIF block around; carry it over verbatim
+    # instead of parsing and re-serializing it.
+    exif_bytes = img.info.get('exif')
+
+    # JPEG has no alpha channel. JPEG inputs are already RGB (or L), and
+    # a fully-opaque PNG only needs a cheap mode convert, so the
+    # white-background composite — a second full-size allocation plus a
+    # per-pixel blend — runs only for genuinely translucent input.
+    if img.format != 'JPEG' and img.mode in ('RGBA', 'LA', 'P'):
+        if img.mode == 'P':
+            img = img.convert('RGBA')
+        if 'A' in img.getbands() and img.getextrema()[-1][0] < 255:
+            background = Image.new('RGB', img.size, (255, 255, 255))
+            background.paste(img, mask=img.split()[-1])
+            img = background
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+
+    width, height = img.size
+    if width > max_width:
+        new_height = int(height * max_width / width)
+        # The IDCT pre-scale above already handled any large factor, so
+        # this resize is at most 2x. At that ratio bilinear is visually
+        # indistinguishable from the 8-tap Lanczos kernel and several
+        # times cheaper.
+        img = img.resize((max_width, new_height), Image.Resampling.BILINEAR)
+
+    if turbojpeg and TurboJPEG is not None:
+        return _save_turbojpeg(img, output_path, quality, exif_bytes)
+
+    # optimize=True runs a second Huffman pass to build per-image
+    # tables: ~3-5% smaller files for ~40% more encode CPU, so it's
+    # reserved for a final publish run.
+    # subsampling=2 pins chroma to 4:2:0 — Pillow would pick 4:2:2 at
+    # this quality, doubling the chroma DCT/Huffman work for no visible
+    # gain in web output. Matches the TurboJPEG path above.
+    save_kwargs = {'quality': quality, 'optimize': optimize,
+                   'progressive': progressive, 'subsampling': 2}
+    if exif_bytes:
+        save_kwargs['exif'] = exif_bytes
+    # Encode into memory first: the buffer length gives the compressed
+    # size without a stat after the write, the bytes stay cache-warm
+    # for the write, and the file is written with one syscall.
+    buf = io.BytesIO()
+    img.save(buf, 'JPEG', **save_kwargs)
+    data = buf.getbuffer()
+    Path(output_path).write_bytes(data)
+    return len(data)
+
+
+def _backup_original(img_file, backup_file, mode):
+    """Back up one original using the cheapest mechanism available.
+
+    The originals are immutable in this workflow, so a reflink (CoW
+    clone on btrfs/XFS/APFS) or a hardlink preserves them without
+    copying any data. reflink falls back to a plain copy on filesystems
+    that don't support it.
+    """
+    if mode == 'reflink' and sys.platform.startswith('linux'):
+        result = subprocess.run(
+            ['cp', '--reflink=auto', str(img_file), str(backup_file)],
+            capture_output=True)
+        if result.returncode == 0:
+            return
+    elif mode == 'hardlink':
+        try:
+            os.link(img_file, backup_file)
+            return
+        except OSError:
+            pass  # cross-device or unsupported; fall through to copy
+    elif mode == 'symlink':
+        # Reprocessing runs find the previous link already in place;
+        # drop it first or os.symlink raises FileExistsError.
+        backup_file.unlink(missing_ok=True)
+        os.symlink(img_file.resolve(), backup_file)
+        return
+    # 'copy' mode and all fallbacks: copyfile (not copy2) so the kernel
+    # fast path (sendfile/copy_file_range on Linux) handles the bytes;
+    # the backup doesn't need the original's mtime preserved.
+    shutil.copyfile(img_file, backup_file)
+
+
+def _process_one(img_file, output_file, backup_file, original_size,
+                 max_width, quality, progressive, optimize, turbojpeg,
+                 backup_mode, img=None):
+    """Worker: optimize one photo and back up the original.
+
+    Runs in a pool process; returns (new_name, original_size,
+    optimized_size, error) — error is None on success, otherwise the
+    exception text — so all printing stays in the parent. The original
+    size comes from the pre-scan's stat of the same file.
+    """
+    try:
+        optimized_size = optimize_image(img_file, output_file, max_width,
+                                        quality, progressive, optimize,
+                                        turbojpeg, img=img)
+        _backup_original(img_file, backup_file, backup_mode)
+        return (output_file.name, original_size, optimized_size, None)
+    except Exception as exc:
+        return (output_file.name, 0, 0, f"{type(exc).__name__}: {exc}")
+
+
+def _process_one_star(task):
+    """Unpack a task tuple for ProcessPoolExecutor.map."""
+    return _process_one(*task)
+
+
+def _run_pipelined(tasks):
+    """Single-process path: pipeline decode against encode.
+
+    A reader thread opens and decodes the next photo while the main
+    thread encodes the current one. Pillow releases the GIL inside
+    libjpeg, so the two genuinely overlap; the bounded queue keeps at
+    most a few decoded images in memory.
+    """
+    q = queue.Queue(maxsize=4)
+
+    def _read_ahead():
+        for task in tasks:
+            img = None
+            try:
+                img = _open_for_resize(task[0], task[4])
+            except Exception:
+                pass  # _process_one retries the open and reports failure
+            q.put((task, img))
+
+    threading.Thread(target=_read_ahead, daemon=True).start()
+    for _ in range(len(tasks)):
+        task, img = q.get()
+        yield _process_one(*task, img=img)
+
+
+def process_photos(input_dir, output_dir, backup_dir, event_name,
+                   max_width=1920, quality=82, jobs=None, progressive=False,
+                   optimize=False, turbojpeg=False, backup_mode='reflink',
+                   force=False):
+    """Optimize every photo in input_dir into output_dir.
+
+    Photos are renamed <event_name>-YYYY-MM-DD-HHMM.jpg from their EXIF
+    capture time, with a numeric suffix on collisions. A .manifest.json
+    sidecar in the output directory records what each source produced,
+    so reruns skip photos that are already done (override with force).
+    """
+    input_path = Path(input_dir)
+    output_path = Path(output_dir)
+    backup_path = Path(backup_dir)
+    output_path.mkdir(parents=True, exist_ok=True)
+    backup_path.mkdir(parents=True, exist_ok=True)
+
+    # scandir's DirEntry.is_file answers from the d_type readdir already
+    # returned, so listing a huge directory costs no stat per entry
+    # (Path.iterdir + Path.is_file would stat every one).
+    image_extensions = {'jpg', 'jpeg', 'png'}
+    with os.scandir(input_path) as it:
+        image_files = sorted(
+            Path(entry.path) for entry in it
+            if entry.is_file(follow_symlinks=False)
+            and entry.name.rsplit('.', 1)[-1].lower() in image_extensions)
+
+    if not image_files:
+        print(f"No photos found in {input_dir}")
+        return
+
+    print(f"Processing {len(image_files)} photos from {input_dir}...")
+
+    # The manifest records (src_mtime, src_size, dst_name, dst_size)
+    # per source file so a rerun can skip finished photos without
+    # hashing anything — the common case after fixing one bad shot.
+    manifest_path = output_path / '.manifest.json'
+    manifest = {}
+    try:
+        manifest = json.loads(manifest_path.read_text())
+    except (OSError, ValueError):
+        pass
+
+    # Sequential pre-scan: assign every output name before any worker
+    # starts, so burst shots with identical timestamps get stable,
+    # deterministic suffixes. Seeding the set with one readdir replaces
+    # a stat syscall per collision probe — O(n^2) of them for a burst
+    # of same-timestamp shots.
+    assigned = set(os.listdir(output_path))
+    tasks = []
+    pending = {}
+    skipped = 0
+    for img_file in image_files:
+        # One stat per file, reused for both the mtime fallback and the
+        # size report; syscalls serialize at the VFS level, so this
+        # matters more once the workers run in parallel.
+        st = img_file.stat()
+        entry = manifest.get(img_file.name)
+        if (not force and entry
+                and entry.get('src_mtime') == st.st_mtime
+                and entry.get('src_size') == st.st_size
+                and (output_path / entry['dst_name']).exists()
+                and (backup_path / img_file.name).exists()):
+            skipped += 1
+            continue
+        if entry and entry.get('dst_name'):
+            # Reprocessing a known source (--force, or it changed):
+            # overwrite its previous output instead of minting a -1
+            # duplicate next to it.
+            assigned.discard(entry['dst_name'])
+        taken_at = get_exif_datetime(img_file, fallback_mtime=st.st_mtime)
+        base_name = f"{event_name}-{taken_at.strftime('%Y-%m-%d-%H%M')}"
+        new_filename = f"{base_name}.jpg"
+        counter = 1
+        while new_filename in assigned:
+            new_filename = f"{base_name}-{counter}.jpg"
+            counter += 1
+        assigned.add(new_filename)
+        pending[new_filename] = (img_file.name, st.st_mtime, st.st_size)
+        tasks.append((img_file, output_path / new_filename,
+                      backup_path / img_file.name, st.st_size, max_width,
+                      quality, progressive, optimize, turbojpeg,
+                      backup_mode))
+
+    if skipped:
+        print(f"Skipping {skipped} already-optimized photos "
+              f"(use --force to redo them)")
+    if not tasks:
+        print("Nothing to do")
+        return
+
+    jobs = jobs or os.cpu_count()
+
+    def _results():
+        if jobs == 1:
+            yield from _run_pipelined(tasks)
+        else:
+            with ProcessPoolExecutor(max_workers=jobs) as ex:
+                yield from ex.map(_process_one_star, tasks, chunksize=4)
+
+    # Buffer the per-file report and flush it in batches: a print per
+    # photo means a PTY flush (and a GIL hold) between encode
+    # iterations, which becomes a contention point with many workers.
+    report_lines = []
+
+    def _flush_report():
+        if report_lines:
+            sys.stdout.write('\n'.join(report_lines) + '\n')
+            report_lines.clear()
+
+    total_original = 0
+    total_optimized = 0
+    failed = 0
+    for new_name, original_size, optimized_size, error in _results():
+        src_name, src_mtime, src_size = pending[new_name]
+        if error:
+            failed += 1
+            report_lines.append(f"  FAILED: {src_name} -> {new_name}: {error}")
+        else:
+            manifest[src_name] = {'src_mtime': src_mtime,
+                                  'src_size': src_size,
+                                  'dst_name': new_name,
+                                  'dst_size': optimized_size}
+            total_original += original_size
+            total_optimized += optimized_size
+            saved = (1 - optimized_size / original_size) * 100 if original_size else 0
+            report_lines.append(f"  {new_name}: {original_size / 1024:.0f} KB -> "
+                                f"{optimized_size / 1024:.0f} KB "
+                                f"(saved {saved:.0f}%)")
+        if len(report_lines) >= 100:
+            _flush_report()
+    _flush_report()
+
+    manifest_path.write_text(json.dumps(manifest, indent=2, sort_keys=True))
+
+    print()
+    print(f"Done: {len(tasks) - failed} photos optimized, {failed} failed")
+    if total_original:
+        print(f"Total: {total_original / 1024 / 1024:.1f} MB -> "
+              f"{total_optimized / 1024 / 1024:.1f} MB "
+              f"(saved {(1 - total_optimized / total_original) * 100:.0f}%)")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Optimize event photos for the bi-gnomon galleries.")
+    parser.add_argument('input_dir', help="directory with the original photos")
+    parser.add_argument('output_dir', help="gallery directory for optimized photos")
+    parser.add_argument('backup_dir', help="directory to back up originals into")
+    parser.add_argument('event_name', help="name prefix, e.g. 'equinox' or 'solstice'")
+    parser.add_argument('--max-width', type=int, default=1920,
+                        help="maximum output width in pixels (default: 1920)")
+    parser.add_argument('--quality', type=int, default=82,
+                        help="JPEG quality 1-95 (default: 82)")
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(),
+                        help="number of worker processes (default: CPU count)")
+    parser.add_argument('--progressive', action='store_true',
+                        help="write progressive JPEGs (slower to encode; "
+                             "baseline is smaller-is-all-that-matters default)")
+    parser.add_argument('--optimize', action=argparse.BooleanOptionalAction,
+                        default=False,
+                        help="run the extra Huffman-optimization pass "
+                             "(~3-5%% smaller files, ~40%% more encode CPU; "
+                             "use for the final publish run)")
+    parser.add_argument('--turbojpeg', action='store_true',
+                        help="encode through PyTurboJPEG instead of Pillow "
+                             "(needs the turbojpeg and numpy packages; "
+                             "falls back to Pillow when missing)")
+    parser.add_argument('--backup-mode', default='reflink',
+                        choices=('copy', 'reflink', 'hardlink', 'symlink'),
+                        help="how to back up originals (default: reflink, "
+                             "which falls back to copy when the filesystem "
+                             "doesn't support CoW clones)")
+    parser.add_argument('--force', action='store_true',
+                        help="reprocess photos the manifest says are "
+                             "already done")
+    args = parser.parse_args()
+
+    if not Path(args.input_dir).is_dir():
+        print(f"Error: {args.input_dir} is not a directory")
+        sys.exit(1)
+
+    check_jpeg_backend()
+
+    if args.turbojpeg:
+        if TurboJPEG is None:
+            print("WARNING: --turbojpeg requested but the turbojpeg/numpy "
+                  "packages are not installed; falling back to Pillow. "
+                  "Install with: pip install PyTurboJPEG numpy")
+            args.turbojpeg = False
+        else:
+            # The pip package can be installed while the native
+            # libturbojpeg is missing, in which case the constructor
+            # raises — inside every worker, failing the whole batch.
+            # Probe it once here and fall back to Pillow instead.
+            try:
+                TurboJPEG()
+            except (RuntimeError, OSError) as exc:
+                print(f"WARNING: --turbojpeg requested but TurboJPEG is "
+                      f"unusable ({exc}); falling back to Pillow.")
+                args.turbojpeg = False
+
+    if args.progressive and platform.machine() in ('aarch64', 'arm64'):
+        # Progressive Huffman coding only gained NEON SIMD in
+        # libjpeg-turbo 2.1; older ARM builds fall back to a scalar
+        # pass that can be ~10x slower than baseline.
+        print("WARNING: progressive JPEG encoding may be much slower on "
+              "ARM unless libjpeg-turbo >= 2.1 is present.")
+
+    process_photos(args.input_dir, args.output_dir, args.backup_dir,
+                   args.event_name, args.max_width, args.quality, args.jobs,
+                   args.progressive, args.optimize, args.turbojpeg,
+                   args.backup_mode, args.force)
+
+
+if __name__ == '__main__':
+    main()